@@ -3,10 +3,13 @@ import re
 import json
 import time
 import html
+import hmac
 import hashlib
+import secrets
+import sqlite3
+import threading
+import contextlib
 import datetime as dt
-import pandas as pd
-import altair as alt
 import streamlit as st
 
 # Optional OpenAI import (app works without it)
@@ -16,6 +19,21 @@ try:
 except Exception:
     OPENAI_AVAILABLE = False
 
+# Optional HTTP/2 for the OpenAI client (needs the h2 package; HTTP/1.1 otherwise)
+try:
+    import h2  # noqa: F401
+    from openai import DefaultHttpxClient
+    HTTP2_AVAILABLE = True
+except Exception:
+    HTTP2_AVAILABLE = False
+
+# Optional orjson import (faster plan decoding; stdlib json otherwise)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except Exception:
+    ORJSON_AVAILABLE = False
+
 # ===================== Page Config =====================
 st.set_page_config(
     page_title="AI Wellness Coach Pro",
@@ -25,11 +43,16 @@ st.set_page_config(
 )
 
 # ===================== CSS & Theme =====================
-def apply_css(css_style: str) -> None:
-    st.markdown("<style>" + css_style + "</style>", unsafe_allow_html=True)
+_CSS_COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+_CSS_SPACE_RE = re.compile(r"\s+")
+_CSS_PUNCT_RE = re.compile(r"\s*([{};:,>])\s*")
 
-def ensure_sidebar_shown():
-    css = """
+def minify_css(css_style: str) -> str:
+    css = _CSS_COMMENT_RE.sub("", css_style)
+    css = _CSS_SPACE_RE.sub(" ", css)
+    return _CSS_PUNCT_RE.sub(r"\1", css).replace(";}", "}").strip()
+
+_BASE_CSS = """
     /* Keep sidebar visible and styled */
     [data-testid="stSidebar"]{
       background: linear-gradient(180deg, rgba(21,32,42,0.9) 0%, rgba(15,20,25,0.9) 100%);
@@ -91,16 +114,38 @@ def ensure_sidebar_shown():
     #MainMenu{visibility:hidden;}
     footer{visibility:hidden;}
     """
-    apply_css(css)
+# Built once at import. The markdown element itself must still be emitted on every
+# run: Streamlit drops elements a rerun does not re-emit, so a once-per-session
+# guard would strip the styling after the first interaction.
+_BASE_CSS_HTML = "<style>" + minify_css(_BASE_CSS) + "</style>"
+
+def ensure_sidebar_shown():
+    st.markdown(_BASE_CSS_HTML, unsafe_allow_html=True)
 
 ensure_sidebar_shown()
 
 # ===================== Utilities & Security =====================
-def sha256_hash(text: str) -> str:
-    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+PBKDF2_ITERATIONS = 100_000
+
+def _pbkdf2_digest(plain: str, salt: bytes, iterations: int) -> bytes:
+    # OpenSSL-backed; uses the CPU's SHA extensions where available
+    return hashlib.pbkdf2_hmac("sha256", plain.encode("utf-8"), salt, iterations)
+
+def hash_password(plain: str) -> str:
+    # Stored as "pbkdf2_sha256$<iterations>$<salt hex>$<digest hex>" with a fresh per-user salt
+    salt = secrets.token_bytes(16)
+    digest = _pbkdf2_digest(plain, salt, PBKDF2_ITERATIONS)
+    return "pbkdf2_sha256$" + str(PBKDF2_ITERATIONS) + "$" + salt.hex() + "$" + digest.hex()
 
 def verify_password(plain: str, hashed: str) -> bool:
-    return sha256_hash(plain) == hashed
+    try:
+        scheme, iterations, salt_hex, digest_hex = hashed.split("$")
+        if scheme != "pbkdf2_sha256":
+            return False
+        actual = _pbkdf2_digest(plain, bytes.fromhex(salt_hex), int(iterations))
+        return hmac.compare_digest(actual, bytes.fromhex(digest_hex))
+    except Exception:
+        return False
 
 def sanitize_text(s: str) -> str:
     if s is None:
@@ -116,6 +161,19 @@ def safe_rerun():
         except Exception:
             pass
 
+# Fragments (st.fragment, or st.experimental_fragment on 1.33-1.36) rerun only their own
+# body on interaction; on older Streamlit the decorator is a no-op and the page reruns.
+fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda func: func)
+
+def flash(message: str, icon: str = "✅") -> None:
+    # Queue a toast for the next run; anything rendered right before a rerun is never seen
+    st.session_state._flash_message = (message, icon)
+
+def show_flash() -> None:
+    pending = st.session_state.pop("_flash_message", None)
+    if pending:
+        st.toast(pending[0], icon=pending[1])
+
 def bmi_calc(weight_kg: float, height_cm: float) -> float:
     try:
         h_m = max(0.3, float(height_cm) / 100.0)
@@ -130,23 +188,77 @@ def weight_delta(current_kg: float, goal_kg: float) -> float:
     except Exception:
         return 0.0
 
+# The SDK retries connection errors, 408/409/429 and 5xx with exponential backoff
+OPENAI_MAX_RETRIES = 3
+
+# Every call fails fast on an unreachable host (3 s connect). The streamed chat reads
+# chunk by chunk, so 30 s per read is plenty; non-streamed completions (the week plan)
+# send nothing until the whole answer is done, so they keep the SDK's 600 s read budget.
+try:
+    from openai import Timeout
+    CHAT_TIMEOUT = Timeout(30.0, connect=3.05)
+    COMPLETION_TIMEOUT = Timeout(600.0, connect=3.05)
+except Exception:
+    CHAT_TIMEOUT = 30.0
+    COMPLETION_TIMEOUT = 600.0
+
+@st.cache_resource(show_spinner=False)
+def _shared_openai_client(key: str):
+    # One client per API key, shared by all sessions; the SDK's own HTTP client keeps a
+    # pooled keep-alive connection, so calls skip the TLS handshake after the first.
+    # With h2 installed, concurrent calls also multiplex over that one connection.
+    http_client = DefaultHttpxClient(http2=True) if HTTP2_AVAILABLE else None
+    return OpenAI(api_key=key, timeout=CHAT_TIMEOUT, max_retries=OPENAI_MAX_RETRIES, http_client=http_client)
+
 def get_openai_client():
     # Prioritize state key if user sets in Settings
     key = st.session_state.get("openai_api_key") or os.environ.get("OPENAI_API_KEY")
     if not key or not OPENAI_AVAILABLE:
         return None
     try:
-        return OpenAI(api_key=key)
+        return _shared_openai_client(key)
     except Exception:
         return None
 
+# ===================== User Store =====================
+# Accounts live in a SQLite file shared by every session (cache_resource = one
+# connection per server process), so signups survive reloads and restarts.
+USER_DB_PATH = os.environ.get("WELLNESS_USER_DB", "users.db")
+
+@st.cache_resource
+def get_user_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(USER_DB_PATH, check_same_thread=False)
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS users (email TEXT PRIMARY KEY, password_hash TEXT NOT NULL)")
+    seed_demo_user(conn)
+    return conn
+
+@st.cache_resource
+def _user_db_lock() -> threading.Lock:
+    return threading.Lock()
+
+def seed_demo_user(conn: sqlite3.Connection) -> None:
+    # demo user: demo@demo.com / demo
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO users (email, password_hash) VALUES (?, ?)", ("demo@demo.com", hash_password("demo")))
+
+def get_password_hash(email: str):
+    with _user_db_lock():
+        row = get_user_db().execute("SELECT password_hash FROM users WHERE email = ?", (email,)).fetchone()
+    return row[0] if row else None
+
+def create_user(email: str, password: str) -> bool:
+    # False if the email is already registered. Hash first: PBKDF2 is deliberately slow
+    # and must not hold the store lock.
+    password_hash = hash_password(password)
+    with _user_db_lock():
+        conn = get_user_db()
+        with conn:
+            cur = conn.execute("INSERT OR IGNORE INTO users (email, password_hash) VALUES (?, ?)", (email, password_hash))
+    return cur.rowcount == 1
+
 # ===================== State Init =====================
 def init_state():
-    if "users" not in st.session_state:
-        # demo user: demo@demo.com / demo
-        st.session_state.users = {
-            "demo@demo.com": sha256_hash("demo")
-        }
     if "logged_in" not in st.session_state:
         st.session_state.logged_in = False
     if "user_email" not in st.session_state:
@@ -155,12 +267,17 @@ def init_state():
         st.session_state.nav = "Dashboard"
     if "chat_history" not in st.session_state:
         st.session_state.chat_history = []  # list of dicts: {"role": "user"|"assistant", "content": "..."}
+    if "chat_summary" not in st.session_state:
+        st.session_state.chat_summary = ""  # running summary of turns older than the chat window
+        st.session_state.chat_summarized = 0  # number of chat_history messages folded into it
     if "weight_log" not in st.session_state:
-        st.session_state.weight_log = pd.DataFrame(columns=["date", "weight_kg"])
+        st.session_state.weight_log = None  # DataFrame built on first Dashboard visit
     if "plan_data" not in st.session_state:
         st.session_state.plan_data = None
     if "plans_generated" not in st.session_state:
         st.session_state.plans_generated = 0
+    if "plan_nonce" not in st.session_state:
+        st.session_state.plan_nonce = 0  # cache-key salt for plans; Regenerate sets a fresh one
     if "profile" not in st.session_state:
         st.session_state.profile = {
             "age": 30,
@@ -177,26 +294,68 @@ def init_state():
 init_state()
 
 # ===================== Cached API Helpers =====================
-@st.cache_data(show_spinner=False, ttl=3600)
-def cached_generate_api_call(prompt: str) -> str:
+PLAN_SYSTEM_PROMPT = "You are a precise wellness planner that outputs strict JSON following the requested schema only."
+# Model tiers: the streamed coach chat and the plan stay on CHAT_MODEL/PLAN_MODEL;
+# short templated helper prompts (e.g. chat summaries) use AUX_MODEL with tight output caps.
+CHAT_MODEL = "gpt-4o-mini"
+PLAN_MODEL = "gpt-4o-mini"
+AUX_MODEL = "gpt-4o-mini"
+
+LLM_MAX_CONCURRENCY = 8
+LLM_SLOT_TIMEOUT = 30  # seconds to wait for a free slot before falling back
+
+@st.cache_resource
+def _llm_semaphore() -> threading.BoundedSemaphore:
+    # Shared by every session: concurrent LLM calls queue here instead of racing the rate limit
+    return threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+
+@contextlib.contextmanager
+def llm_slot():
+    # Hold one of the shared slots; a stalled call must not leave everyone else waiting
+    # forever, so give up after LLM_SLOT_TIMEOUT and let the caller's fallback take over
+    semaphore = _llm_semaphore()
+    if not semaphore.acquire(timeout=LLM_SLOT_TIMEOUT):
+        raise RuntimeError("LLM_BUSY")
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+def run_completion(prompt: str, system: str = PLAN_SYSTEM_PROMPT, model: str = PLAN_MODEL, max_tokens=None) -> str:
+    # One non-streamed completion, uncached; raises on failure
     client = get_openai_client()
     if client is None:
-        # Return sentinel so caller can fallback
-        return "ERROR::NO_OPENAI"
-    try:
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
+        raise RuntimeError("NO_OPENAI")
+    extra = {"max_tokens": max_tokens} if max_tokens else {}
+    with llm_slot():
+        resp = client.with_options(timeout=COMPLETION_TIMEOUT).chat.completions.create(
+            model=model,
             messages=[
-                {"role": "system", "content": "You are a precise wellness planner that outputs strict JSON following the requested schema only."},
+                {"role": "system", "content": system},
                 {"role": "user", "content": prompt},
             ],
             temperature=0.4,
+            **extra,
         )
-        return resp.choices[0].message.content or ""
+    return resp.choices[0].message.content or ""
+
+@st.cache_data(show_spinner=False, ttl=7 * 86400, max_entries=2048)
+def cached_generate_api_call(prompt: str, system: str = PLAN_SYSTEM_PROMPT, model: str = PLAN_MODEL, max_tokens=None, nonce: int = 0) -> str:
+    # Raises on failure: st.cache_data does not store exceptions, so errors are retried
+    # on the next call instead of being served from cache for the whole TTL.
+    # nonce is only part of the cache key: a new value forces one fresh completion.
+    return run_completion(prompt, system=system, model=model, max_tokens=max_tokens)
+
+def generate_api_call(prompt: str, system: str = PLAN_SYSTEM_PROMPT, model: str = PLAN_MODEL, max_tokens=None, nonce: int = 0) -> str:
+    try:
+        return cached_generate_api_call(prompt, system=system, model=model, max_tokens=max_tokens, nonce=nonce)
     except Exception as e:
+        # Return sentinel so caller can fallback
         return "ERROR::" + str(e)
 
 # ===================== Plan Parsing & Fallback =====================
+_JSON_FENCE_RE = re.compile(r"```(?:json)?\s*(\{.*?\})\s*```", re.S)
+
 def local_week_plan_fallback() -> dict:
     # Deterministic 7-day plan for offline mode
     meals = [
@@ -226,16 +385,19 @@ def local_week_plan_fallback() -> dict:
         "disclaimer": "This plan is for educational purposes only and does not replace professional medical advice.",
     }
 
+@st.cache_data(show_spinner=False, max_entries=32)
 def parse_weekly_plan(text: str) -> dict:
-    if not text or text.startswith("ERROR::"):
+    # Substring checks are cheap C scans; they rule out regex and JSON work on bad output
+    if not text or text.startswith("ERROR::") or "week_plan" not in text:
         return local_week_plan_fallback()
     # Try to extract JSON block if the model wrapped it in markdown
     json_text = text.strip()
-    fence_match = re.search(r"```(?:json)?\s*(\{.*?\})\s*```", json_text, re.S)
-    if fence_match:
-        json_text = fence_match.group(1)
+    if "```" in json_text:
+        fence_match = _JSON_FENCE_RE.search(json_text)
+        if fence_match:
+            json_text = fence_match.group(1)
     try:
-        data = json.loads(json_text)
+        data = orjson.loads(json_text) if ORJSON_AVAILABLE else json.loads(json_text)
         # Minimal shape validation
         if "week_plan" in data and isinstance(data["week_plan"], list):
             return data
@@ -244,46 +406,49 @@ def parse_weekly_plan(text: str) -> dict:
     # Heuristic fallback if not valid JSON
     return local_week_plan_fallback()
 
+_PLAN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "week_plan": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "day": {"type": "string"},
+                    "calories": {"type": "integer"},
+                    "meals": {"type": "array", "items": {
+                        "type": "object",
+                        "properties": {
+                            "name": {"type": "string"},
+                            "portion": {"type": "string"},
+                            "recipe": {"type": "string"}
+                        },
+                        "required": ["name","portion","recipe"]
+                    }},
+                    "exercises": {"type": "array", "items": {
+                        "type": "object",
+                        "properties": {
+                            "name": {"type": "string"},
+                            "sets": {"type": "integer"},
+                            "reps": {"type": "string"},
+                            "cues": {"type": "string"}
+                        },
+                        "required": ["name","sets","reps","cues"]
+                    }},
+                    "motivation": {"type": "string"}
+                },
+                "required": ["day","calories","meals","exercises","motivation"]
+            }
+        },
+        "disclaimer": {"type": "string"}
+    },
+    "required": ["week_plan", "disclaimer"]
+}
+# Serialized once at import; every plan prompt embeds the same text
+_PLAN_SCHEMA_JSON = json.dumps(_PLAN_SCHEMA)
+
 def _build_plan_prompt() -> str:
     p = st.session_state.profile
-    schema = {
-        "type": "object",
-        "properties": {
-            "week_plan": {
-                "type": "array",
-                "items": {
-                    "type": "object",
-                    "properties": {
-                        "day": {"type": "string"},
-                        "calories": {"type": "integer"},
-                        "meals": {"type": "array", "items": {
-                            "type": "object",
-                            "properties": {
-                                "name": {"type": "string"},
-                                "portion": {"type": "string"},
-                                "recipe": {"type": "string"}
-                            },
-                            "required": ["name","portion","recipe"]
-                        }},
-                        "exercises": {"type": "array", "items": {
-                            "type": "object",
-                            "properties": {
-                                "name": {"type": "string"},
-                                "sets": {"type": "integer"},
-                                "reps": {"type": "string"},
-                                "cues": {"type": "string"}
-                            },
-                            "required": ["name","sets","reps","cues"]
-                        }},
-                        "motivation": {"type": "string"}
-                    },
-                    "required": ["day","calories","meals","exercises","motivation"]
-                }
-            },
-            "disclaimer": {"type": "string"}
-        },
-        "required": ["week_plan", "disclaimer"]
-    }
     prompt = f"""
 Generate a 7-day wellness plan as strict JSON only (no extra text). Personalize to:
 - Age: {p['age']}
@@ -303,37 +468,112 @@ For each day include:
 Add a global medical disclaimer string.
 
 JSON schema to follow exactly:
-{json.dumps(schema)}
+{_PLAN_SCHEMA_JSON}
 """
     return prompt
 
 # ===================== Streaming Chat =====================
-def stream_chat_to_ui(user_prompt: str) -> str:
-    # maintain memory: last 10 messages
-    history = st.session_state.chat_history[-10:]
-    messages = [{"role": "system", "content": "You are an evidence-based, friendly AI health coach. Keep replies concise and practical."}]
-    messages.extend(history)
-    messages.append({"role": "user", "content": user_prompt})
+# Each repaint re-parses the whole growing reply as markdown; ~10 Hz keeps long
+# answers smooth without the quadratic cost of repainting per token.
+CHAT_RENDER_INTERVAL_MS = 100
+
+def _batched_deltas(stream, window_ms: int = CHAT_RENDER_INTERVAL_MS):
+    # Group token deltas into ~window_ms batches so the UI repaints per batch, not per token
+    buf = []
+    t0 = time.monotonic()
+    for chunk in stream:
+        # Some chunks (e.g. a trailing usage chunk) carry no choices at all
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            buf.append(delta)
+        if buf and time.monotonic() - t0 >= window_ms / 1000.0:
+            yield "".join(buf)
+            buf = []
+            t0 = time.monotonic()
+    if buf:
+        yield "".join(buf)
+
+CHAT_MAX_TURNS = 8  # user/assistant pairs sent verbatim; older turns are folded into a summary
+CHAT_SUMMARY_SYSTEM_PROMPT = "You condense wellness coaching conversations into brief factual notes."
+
+def update_chat_summary(history: list) -> None:
+    # Fold messages that slid out of the window into the running summary, a batch of
+    # CHAT_MAX_TURNS turns at a time so the extra LLM call is rare rather than per turn
+    older = history[:-CHAT_MAX_TURNS * 2]
+    done = st.session_state.chat_summarized
+    if len(older) - done < CHAT_MAX_TURNS * 2:
+        return
+    transcript = "\n".join(m["role"] + ": " + m["content"] for m in older[done:])
+    prompt = (
+        "Current summary:\n" + (st.session_state.chat_summary or "(none)")
+        + "\n\nNew messages:\n" + transcript
+        + "\n\nRewrite the summary to include the new messages. Keep the user's goals, constraints, "
+        "and any advice already given. Max 120 words, plain text."
+    )
+    # Uncached: every transcript is unique and private, so it must not sit in the shared plan cache
+    try:
+        summary = run_completion(prompt, system=CHAT_SUMMARY_SYSTEM_PROMPT, model=AUX_MODEL, max_tokens=200)
+    except Exception:
+        return
+    if summary:
+        st.session_state.chat_summary = summary.strip()
+        st.session_state.chat_summarized = len(older)
+
+def _split_closed_blocks(text: str):
+    # Split streamed markdown into finished blocks (ended by a blank line) and the
+    # still-growing tail; a blank line inside an open ``` fence does not end a block.
+    parts = text.split("\n\n")
+    closed, pending = [], []
+    for part in parts[:-1]:
+        pending.append(part)
+        joined = "\n\n".join(pending)
+        if joined.count("```") % 2 == 0:
+            closed.append(joined)
+            pending = []
+    pending.append(parts[-1])
+    return closed, "\n\n".join(pending)
 
+def stream_chat_to_ui(user_prompt: str) -> str:
     client = get_openai_client()
     if client is None:
         # fallback local heuristic
         return local_coach(user_prompt)
 
+    # The caller may already have appended this prompt to the history; don't send it twice
+    prior = st.session_state.chat_history
+    if prior and prior[-1] == {"role": "user", "content": user_prompt}:
+        prior = prior[:-1]
+
+    # maintain memory: running summary + every turn not yet folded into it
+    messages = [{"role": "system", "content": "You are an evidence-based, friendly AI health coach. Keep replies concise and practical."}]
+    if st.session_state.chat_summary:
+        messages.append({"role": "system", "content": "Summary of earlier conversation: " + st.session_state.chat_summary})
+    # (capped at two windows in case summarizing keeps failing)
+    messages.extend(prior[max(st.session_state.chat_summarized, len(prior) - CHAT_MAX_TURNS * 4):])
+    messages.append({"role": "user", "content": user_prompt})
+
     try:
+        # Finished blocks are written once into their own element; each tick only
+        # re-renders the tail block instead of re-parsing the whole reply.
         placeholder = st.empty()
         full_text = ""
-        stream = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.4,
-            stream=True,
-        )
-        for chunk in stream:
-            delta = getattr(chunk.choices[0].delta, "content", None)
-            if delta:
-                full_text += delta
-                placeholder.markdown(sanitize_text(full_text))
+        tail_start = 0
+        # Hold the slot for the whole stream: the request is in flight until the last chunk
+        with llm_slot():
+            stream = client.chat.completions.create(
+                model=CHAT_MODEL,
+                messages=messages,
+                temperature=0.4,
+                stream=True,
+            )
+            for piece in _batched_deltas(stream):
+                full_text += piece
+                closed, tail = _split_closed_blocks(full_text[tail_start:])
+                for block in closed:
+                    placeholder.markdown(sanitize_text(block))
+                    placeholder = st.empty()
+                    tail_start += len(block) + 2
+                placeholder.markdown(sanitize_text(tail))
         return full_text if full_text.strip() else "I am here to help with wellness questions!"
     except Exception as e:
         st.error("Streaming error: " + str(e))
@@ -352,6 +592,12 @@ def local_coach(q: str) -> str:
     return "Keep it simple: pick one small habit for today, do it, and celebrate the win."
 
 # ===================== Sidebar =====================
+# Button callbacks mutate state before the rerun, so each click costs one script run
+def _do_logout():
+    # One dict clear instead of per-key deletes; accounts live in the user store
+    st.session_state.clear()
+    init_state()
+
 def build_sidebar():
     with st.sidebar:
         st.title("AI Wellness Coach")
@@ -380,67 +626,111 @@ def build_sidebar():
         st.divider()
         col_a, col_b = st.columns(2)
         with col_a:
-            if st.button("Logout"):
-                st.session_state.logged_in = False
-                st.session_state.user_email = None
-                safe_rerun()
+            st.button("Logout", on_click=_do_logout)
         with col_b:
             st.caption("Logged in as: " + (st.session_state.user_email or "Guest"))
 
 # ===================== Auth =====================
+# Static markup, built once at import; the card opening and header go out as one element
+_LOGIN_SHELL_TOP = (
+    '<div class="login-card">'
+    '<div class="login-title">Welcome to AI Wellness Coach Pro</div>'
+    '<div class="login-sub">Sign in, sign up, or use the demo login to explore.</div>'
+)
+_LOGIN_SHELL_BOTTOM = "</div>"
+
+# Form callbacks run before the script reruns, so a successful login renders the
+# dashboard on that same run instead of drawing the login page and rerunning.
+def _do_login():
+    email = st.session_state.get("login_email", "").strip()
+    pw = st.session_state.get("login_password", "")
+    stored = get_password_hash(email)
+    if stored and verify_password(pw, stored):
+        st.session_state.logged_in = True
+        st.session_state.user_email = email
+        flash("Signed in.")
+    else:
+        st.session_state._login_error = "Invalid email or password."
+
+def _do_signup():
+    email = st.session_state.get("signup_email", "").strip()
+    pw = st.session_state.get("signup_password", "")
+    if len(email) == 0 or len(pw) < 3:
+        st.session_state._signup_error = "Please provide a valid email and 3+ char password."
+    elif not create_user(email, pw):
+        st.session_state._signup_error = "User already exists."
+    else:
+        # Pre-fill the Login tab so the new user can sign in right away
+        st.session_state.login_email = email
+        flash(f"Account '{email}' created. Log in now.")
+
+def _do_demo_login():
+    st.session_state.logged_in = True
+    st.session_state.user_email = "demo@demo.com"
+    flash("Logged in as demo.")
+
 def login_page():
     build_sidebar()
-    st.markdown('<div class="login-card">', unsafe_allow_html=True)
-    st.markdown('<div class="login-title">Welcome to AI Wellness Coach Pro</div>', unsafe_allow_html=True)
-    st.markdown('<div class="login-sub">Sign in, sign up, or use the demo login to explore.</div>', unsafe_allow_html=True)
+    st.markdown(_LOGIN_SHELL_TOP, unsafe_allow_html=True)
 
     tabs = st.tabs(["Login", "Sign Up", "Demo Login"])
 
     with tabs[0]:
         with st.form("login_form"):
-            email = st.text_input("Email")
-            pw = st.text_input("Password", type="password")
-            submit = st.form_submit_button("Sign In")
-        if submit:
-            if email.strip() in st.session_state.users and verify_password(pw, st.session_state.users[email.strip()]):
-                st.session_state.logged_in = True
-                st.session_state.user_email = email.strip()
-                st.success("Signed in.")
-                safe_rerun()
-            else:
-                st.error("Invalid email or password.")
+            st.text_input("Email", key="login_email")
+            st.text_input("Password", type="password", key="login_password")
+            st.form_submit_button("Sign In", on_click=_do_login)
+        login_error = st.session_state.pop("_login_error", None)
+        if login_error:
+            st.error(login_error)
 
     with tabs[1]:
         with st.form("signup_form"):
-            email2 = st.text_input("Email (new)")
-            pw2 = st.text_input("Password (min 3 chars)", type="password")
-            submit2 = st.form_submit_button("Create Account")
-        if submit2:
-            if len(email2.strip()) == 0 or len(pw2) < 3:
-                st.error("Please provide a valid email and 3+ char password.")
-            elif email2.strip() in st.session_state.users:
-                st.error("User already exists.")
-            else:
-                st.session_state.users[email2.strip()] = sha256_hash(pw2)
-                st.success("Account created. Please log in.")
+            st.text_input("Email (new)", key="signup_email")
+            st.text_input("Password (min 3 chars)", type="password", key="signup_password")
+            st.form_submit_button("Create Account", on_click=_do_signup)
+        signup_error = st.session_state.pop("_signup_error", None)
+        if signup_error:
+            st.error(signup_error)
 
     with tabs[2]:
-        if st.button("Use Demo Account"):
-            st.session_state.logged_in = True
-            st.session_state.user_email = "demo@demo.com"
-            st.info("Logged in as demo.")
-            safe_rerun()
+        st.button("Use Demo Account", on_click=_do_demo_login)
 
-    st.markdown("</div>", unsafe_allow_html=True)
+    st.markdown(_LOGIN_SHELL_BOTTOM, unsafe_allow_html=True)
 
 # ===================== Dashboard =====================
 def ensure_weight_log_df():
+    import pandas as pd
     if "weight_log" not in st.session_state or not isinstance(st.session_state.weight_log, pd.DataFrame):
         st.session_state.weight_log = pd.DataFrame(columns=["date", "weight_kg"])
     if st.session_state.weight_log.empty:
         # seed with current weight this week
         today = pd.to_datetime(dt.date.today())
-        st.session_state.weight_log = pd.DataFrame([{"date": today, "weight_kg": float(st.session_state.profile["weight_kg"])}])
+        st.session_state.weight_log = pd.DataFrame({"date": [today], "weight_kg": [float(st.session_state.profile["weight_kg"])]})
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def progress_chart_specs(points: tuple) -> tuple:
+    # points: ((iso_date, weight_kg), ...) in date order. Returns (line_spec, weekly_spec)
+    # as Vega-Lite dicts so unrelated reruns skip Altair's builder and serializer.
+    import pandas as pd
+    import altair as alt
+
+    df_plot = pd.DataFrame(list(points), columns=["date", "weight_kg"])
+    df_plot["date"] = pd.to_datetime(df_plot["date"])
+    chart = alt.Chart(df_plot).mark_line(point=True).encode(
+        x=alt.X("date:T", title="Date"),
+        y=alt.Y("weight_kg:Q", title="Weight (kg)"),
+        tooltip=["date:T", "weight_kg:Q"],
+    ).properties(height=320)
+
+    week = df_plot["date"].dt.to_period("W").astype(str).rename("week")
+    weekly = df_plot["weight_kg"].groupby(week).mean().reset_index()
+    wchart = alt.Chart(weekly).mark_bar().encode(
+        x=alt.X("week:N", sort=None, title="Week"),
+        y=alt.Y("weight_kg:Q", title="Avg Weight (kg)"),
+        tooltip=["week:N", "weight_kg:Q"],
+    ).properties(height=240)
+    return chart.to_dict(), wchart.to_dict()
 
 def page_dashboard():
     build_sidebar()
@@ -456,44 +746,48 @@ def page_dashboard():
     c3.metric("Current Weight (kg)", str(p["weight_kg"]))
     c4.metric("Delta to Goal (kg)", str(delta))
 
+    weight_log_section()
+
+@fragment
+def weight_log_section():
+    # Logging an entry only touches the log and charts; keep those reruns local
+    import pandas as pd
+
+    p = st.session_state.profile
     st.subheader("Log Your Weight")
     ensure_weight_log_df()
     log_date = st.date_input("Date", value=dt.date.today())
     log_weight = st.number_input("Weight (kg)", min_value=25.0, max_value=300.0, value=float(p["weight_kg"]), step=0.1)
     add_btn = st.button("Add Entry")
     if add_btn:
-        df = st.session_state.weight_log.copy()
-        new_row = {"date": pd.to_datetime(log_date), "weight_kg": float(log_weight)}
-        df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-        df = df.sort_values("date").reset_index(drop=True)
-        st.session_state.weight_log = df
+        # Append in place (column-wise) and keep the log sorted by date, so
+        # rendering below can use the frame as-is without copying/re-sorting.
+        df = st.session_state.weight_log
+        new_date = pd.to_datetime(log_date)
+        out_of_order = not df.empty and new_date < df["date"].iloc[-1]
+        df.loc[len(df)] = [new_date, float(log_weight)]
+        if out_of_order:
+            df.sort_values("date", inplace=True, kind="stable", ignore_index=True)
         st.success("Entry added.")
 
-    df = st.session_state.weight_log.copy()
-    if not df.empty:
+    df_plot = st.session_state.weight_log
+    if not df_plot.empty:
+        points = tuple(zip(df_plot["date"].dt.strftime("%Y-%m-%d"), df_plot["weight_kg"].astype(float)))
+        line_spec, weekly_spec = progress_chart_specs(points)
+
         st.subheader("Progress Over Time")
-        df_plot = df.sort_values("date")
-        chart = alt.Chart(df_plot).mark_line(point=True).encode(
-            x=alt.X("date:T", title="Date"),
-            y=alt.Y("weight_kg:Q", title="Weight (kg)"),
-            tooltip=["date:T", "weight_kg:Q"],
-        ).properties(height=320)
-        st.altair_chart(chart, use_container_width=True)
+        st.vega_lite_chart(line_spec, use_container_width=True)
 
         st.subheader("Weekly Trend")
-        dfw = df_plot.copy()
-        dfw["week"] = dfw["date"].dt.to_period("W").astype(str)
-        weekly = dfw.groupby("week", as_index=False)["weight_kg"].mean()
-        wchart = alt.Chart(weekly).mark_bar().encode(
-            x=alt.X("week:N", sort=None, title="Week"),
-            y=alt.Y("weight_kg:Q", title="Avg Weight (kg)"),
-            tooltip=["week:N", "weight_kg:Q"],
-        ).properties(height=240)
-        st.altair_chart(wchart, use_container_width=True)
+        st.vega_lite_chart(weekly_spec, use_container_width=True)
     else:
         st.info("No weight entries yet. Add your first entry above.")
 
 # ===================== Plan Generator =====================
+def _clear_plan():
+    st.session_state.plan_data = None
+    flash("Cleared plan.", icon="🗑️")
+
 def page_plan_generator():
     build_sidebar()
     st.header("🗓️ AI-Generated 7-Day Wellness Plan")
@@ -501,96 +795,133 @@ def page_plan_generator():
 
     c1, c2 = st.columns([1, 2])
     with c1:
-        if st.button("Generate 7-Day Plan"):
+        # Completions are cached by prompt, and the prompt is built only from the profile,
+        # so an unchanged profile gets its plan back instantly. Regenerate picks a nonce no
+        # other click (in any session) has used, which misses the shared cache.
+        generate = st.button("Generate 7-Day Plan")
+        regenerate = st.button("Regenerate", help="Ignore the cached plan for this profile and ask the AI for a fresh one.")
+        if generate or regenerate:
+            if regenerate:
+                st.session_state.plan_nonce = time.time_ns()
             with st.spinner("Generating plan..."):
                 prompt = _build_plan_prompt()
-                content = cached_generate_api_call(prompt)
+                content = generate_api_call(prompt, nonce=st.session_state.plan_nonce)
                 parsed = parse_weekly_plan(content)
                 st.session_state.plan_data = parsed
                 st.session_state.plans_generated += 1
                 st.success("Plan generated.")
-        if st.button("Clear Plan"):
-            st.session_state.plan_data = None
-            st.info("Cleared plan.")
+        st.button("Clear Plan", on_click=_clear_plan)
 
     with c2:
-        if st.session_state.plan_data:
-            plan = st.session_state.plan_data
-            days = [d.get("day", "Day " + str(i+1)) for i, d in enumerate(plan.get("week_plan", []))]
-            if not days:
-                st.info("No plan days available yet.")
-                return
-            view_mode = st.toggle("Show full week at once", value=False)
-            if not view_mode:
-                day_name = st.selectbox("Select Day", days)
-                day = next((d for d in plan["week_plan"] if d.get("day") == day_name), plan["week_plan"][0])
-
-                st.subheader(day.get("day", "Day"))
+        plan_viewer()
+
+@fragment
+def plan_viewer():
+    # Day picker and week toggle only redraw the plan, not the page or sidebar
+    if st.session_state.plan_data:
+        plan = st.session_state.plan_data
+        days = [d.get("day", "Day " + str(i+1)) for i, d in enumerate(plan.get("week_plan", []))]
+        if not days:
+            st.info("No plan days available yet.")
+            return
+        view_mode = st.toggle("Show full week at once", value=False)
+        if not view_mode:
+            day_idx = st.selectbox("Select Day", range(len(days)), format_func=lambda i: days[i])
+            day = plan["week_plan"][day_idx]
+
+            st.subheader(day.get("day", "Day"))
+            st.metric("Daily Calorie Target", day.get("calories", "N/A"))
+
+            st.markdown("#### Meals")
+            for m in day.get("meals", []):
+                st.markdown(f"- {sanitize_text(m.get('name',''))} — Portion: {sanitize_text(m.get('portion',''))}")
+                st.caption(sanitize_text(m.get("recipe","")).strip())
+
+            st.markdown("#### Exercises")
+            for ex in day.get("exercises", []):
+                name = sanitize_text(ex.get("name", ""))
+                sets = ex.get("sets", "N/A")
+                reps = sanitize_text(ex.get("reps", ""))
+                cues = sanitize_text(ex.get("cues", ""))
+                st.markdown(f"- {name}: {sets} sets × {reps}")
+                st.caption(cues)
+
+            st.markdown("#### Motivation")
+            st.info(sanitize_text(day.get("motivation","")))
+
+            st.caption(f"**Disclaimer:** {sanitize_text(plan.get('disclaimer', 'Consult a health professional before starting any new diet or exercise regimen.'))}")
+
+        else: # Show full week at once
+            for day in plan.get("week_plan", []):
+                st.markdown("---")
+                st.subheader(f"📅 {day.get('day', 'Day')}")
                 st.metric("Daily Calorie Target", day.get("calories", "N/A"))
 
-                st.markdown("#### Meals")
-                for m in day.get("meals", []):
-                    st.markdown(f"- {sanitize_text(m.get('name',''))} — Portion: {sanitize_text(m.get('portion',''))}")
-                    st.caption(sanitize_text(m.get("recipe","")).strip())
-
-                st.markdown("#### Exercises")
-                for ex in day.get("exercises", []):
-                    name = sanitize_text(ex.get("name", ""))
-                    sets = ex.get("sets", "N/A")
-                    reps = sanitize_text(ex.get("reps", ""))
-                    cues = sanitize_text(ex.get("cues", ""))
-                    st.markdown(f"- {name}: {sets} sets × {reps}")
-                    st.caption(cues)
-
-                st.markdown("#### Motivation")
-                st.info(sanitize_text(day
-                # ... (Previous code up to the incomplete line)
-
-                st.markdown("#### Motivation")
-                st.info(sanitize_text(day.get("motivation","")))
-
-                st.caption(f"**Disclaimer:** {sanitize_text(plan.get('disclaimer', 'Consult a health professional before starting any new diet or exercise regimen.'))}")
-            
-            else: # Show full week at once
-                for day in plan.get("week_plan", []):
-                    st.markdown("---")
-                    st.subheader(f"📅 {day.get('day', 'Day')}")
-                    st.metric("Daily Calorie Target", day.get("calories", "N/A"))
-
-                    col_m, col_e = st.columns(2)
-                    with col_m:
-                        st.markdown("##### Meals")
-                        for m in day.get("meals", []):
-                            st.markdown(f"**{sanitize_text(m.get('name',''))}** — Portion: {sanitize_text(m.get('portion',''))}")
-                            st.caption(sanitize_text(m.get("recipe","")).strip())
-
-                    with col_e:
-                        st.markdown("##### Exercises")
-                        for ex in day.get("exercises", []):
-                            name = sanitize_text(ex.get("name", ""))
-                            sets = ex.get("sets", "N/A")
-                            reps = sanitize_text(ex.get("reps", ""))
-                            cues = sanitize_text(ex.get("cues", ""))
-                            st.markdown(f"**{name}**: {sets} sets × {reps}")
-                            st.caption(cues)
-                    
-                    st.info(f"**Motivation:** {sanitize_text(day.get('motivation',''))}")
-
-                st.markdown("---")
-                st.caption(f"**Disclaimer:** {sanitize_text(plan.get('disclaimer', 'Consult a health professional before starting any new diet or exercise regimen.'))}")
-        else:
-            st.info("No plan generated yet. Hit the 'Generate 7-Day Plan' button to create your personalized weekly wellness plan based on your profile settings in the sidebar.")
+                col_m, col_e = st.columns(2)
+                with col_m:
+                    st.markdown("##### Meals")
+                    for m in day.get("meals", []):
+                        st.markdown(f"**{sanitize_text(m.get('name',''))}** — Portion: {sanitize_text(m.get('portion',''))}")
+                        st.caption(sanitize_text(m.get("recipe","")).strip())
+
+                with col_e:
+                    st.markdown("##### Exercises")
+                    for ex in day.get("exercises", []):
+                        name = sanitize_text(ex.get("name", ""))
+                        sets = ex.get("sets", "N/A")
+                        reps = sanitize_text(ex.get("reps", ""))
+                        cues = sanitize_text(ex.get("cues", ""))
+                        st.markdown(f"**{name}**: {sets} sets × {reps}")
+                        st.caption(cues)
+
+                st.info(f"**Motivation:** {sanitize_text(day.get('motivation',''))}")
+
+            st.markdown("---")
+            st.caption(f"**Disclaimer:** {sanitize_text(plan.get('disclaimer', 'Consult a health professional before starting any new diet or exercise regimen.'))}")
+    else:
+        st.info("No plan generated yet. Hit the 'Generate 7-Day Plan' button to create your personalized weekly wellness plan based on your profile settings in the sidebar.")
 
 # ===================== Chat =====================
+def _clear_chat():
+    st.session_state.chat_history = []
+    st.session_state.chat_summary = ""
+    st.session_state.chat_summarized = 0
+    flash("Chat history cleared.", icon="🗑️")
+
+CHAT_HISTORY_LIMIT = 200  # messages kept in session; older ones live on only in the chat summary
+CHAT_RENDER_LIMIT = 30  # messages drawn by default; the rest only when asked for
+
+def trim_chat_history() -> None:
+    history = st.session_state.chat_history
+    overflow = len(history) - CHAT_HISTORY_LIMIT
+    if overflow > 0:
+        del history[:overflow]
+        st.session_state.chat_summarized = max(0, st.session_state.chat_summarized - overflow)
+
+@fragment
+def chat_history_view():
+    # Markdown rendering dominates long chats, so only the newest messages are drawn
+    history = st.session_state.chat_history
+    older, recent = history[:-CHAT_RENDER_LIMIT], history[-CHAT_RENDER_LIMIT:]
+    # Fixed label and key: a label that changes with the count would be a new widget
+    # (reset to off) after every message
+    if older:
+        st.caption(f"{len(older)} older messages")
+        if st.toggle("Show older messages", value=False, key="chat_show_older"):
+            for message in older:
+                with st.chat_message(message["role"]):
+                    st.markdown(sanitize_text(message["content"]))
+    for message in recent:
+        with st.chat_message(message["role"]):
+            st.markdown(sanitize_text(message["content"]))
+
 def page_chat():
     build_sidebar()
     st.header("💬 AI Wellness Coach Chat")
     st.caption("Ask questions about diet, exercise, stress, or general wellness. The coach maintains context.")
     
     # Display chat messages
-    for message in st.session_state.chat_history:
-        with st.chat_message(message["role"]):
-            st.markdown(sanitize_text(message["content"]))
+    chat_history_view()
 
     # Chat input
     if user_prompt := st.chat_input("Ask your wellness question..."):
@@ -608,15 +939,15 @@ def page_chat():
         
         # Add assistant message to history
         st.session_state.chat_history.append({"role": "assistant", "content": response_content})
+        # Summarize after the reply is on screen so it never delays the first token
+        update_chat_summary(st.session_state.chat_history)
+        trim_chat_history()
         safe_rerun() # Re-run to update the full history display properly after streaming
 
     # Clear chat history button
     if st.session_state.chat_history:
         st.divider()
-        if st.button("Clear Chat"):
-            st.session_state.chat_history = []
-            st.info("Chat history cleared.")
-            safe_rerun()
+        st.button("Clear Chat", on_click=_clear_chat)
 
 # ===================== Settings =====================
 def page_settings():
@@ -639,12 +970,9 @@ def page_settings():
     if st.button("Save API Key"):
         if new_key:
             st.session_state.openai_api_key = new_key.strip()
-            # Clear cache so new client is initialized on next API call
-            cached_generate_api_call.clear() 
             st.success("API Key saved.")
         else:
             st.session_state.openai_api_key = None
-            cached_generate_api_call.clear() 
             st.warning("API Key cleared. AI features will use local fallbacks if available.")
 
     if current_key:
@@ -657,18 +985,19 @@ def page_settings():
     st.divider()
 
     st.subheader("User Management")
-    st.markdown(f"**Total Registered Users:** `{len(st.session_state.users)}`")
     st.markdown(f"**Current User Email:** `{st.session_state.user_email}`")
     
-    if st.button("Factory Reset (Clear All User Data)", help="This will log you out and delete all registered users, weight logs, and chat history."):
-        if st.warning("Are you sure? This action is irreversible."):
-            st.session_state.clear()
-            init_state() # Reinitialize with default state
-            st.success("Application state reset.")
-            safe_rerun()
+    # Resets this session only; registered accounts in the shared user store are untouched
+    confirm_reset = st.checkbox("I understand this clears my profile, weight log, plan, and chat history.")
+    if st.button("Factory Reset (Clear My Session Data)", help="This will log you out and clear your profile, weight log, plan, and chat history.", disabled=not confirm_reset):
+        st.session_state.clear()
+        init_state() # Reinitialize with default state
+        flash("Application state reset.")
+        safe_rerun()
 
 # ===================== Main App Logic =====================
 if __name__ == "__main__":
+    show_flash()
     if not st.session_state.logged_in:
         login_page()
     else: